@@ -1,31 +1,89 @@
 
 import ast
+import hashlib
+import itertools
+import mmap
+import os
+import pickle
+import re
+import sys
+import tempfile
+import tokenize
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
 from typing import List, Dict
 
 from uitils.analysis import (
     extract_docstring,
-    detect_control_flow,
     infer_intent,
+    infer_module_intents,
     infer_file_role,
 )
 
 
+# Bump whenever the shape of the chunk dicts changes so stale cache
+# entries are ignored instead of being served.
+SCHEMA_VERSION = b"9"
+
+AST_CACHE_DIR = Path("output") / "ast-cache"
+
+# Line breaks as counted by the tokenizer (not str.splitlines)
+_NEWLINE = re.compile(rb"\r\n?|\n")
+
+# Directory names pruned by walk_py_files before they are listed
+EXCLUDED_DIRS = frozenset({
+    "venv",
+    ".venv",
+    "__pycache__",
+    "site-packages",
+    "node_modules",
+    ".git",
+    ".tox",
+    ".nox",
+    ".mypy_cache",
+    ".pytest_cache",
+})
+
+
+def _attr_name(node):
+    """
+    Dotted name of an attribute chain, e.g. `self.client.put_object`.
+    Non-name bases (calls, subscripts) are dropped.
+    """
+    parts = []
+    while isinstance(node, ast.Attribute):
+        parts.append(node.attr)
+        node = node.value
+    if isinstance(node, ast.Name):
+        parts.append(node.id)
+    return ".".join(reversed(parts))
+
+
 class PythonChunkExtractor(ast.NodeVisitor):
-    def __init__(self, file_path: str, source_lines: List[str]):
+    def __init__(self, file_path: str, source: bytes, encoding: str = "utf-8"):
         self.file_path = file_path
-        self.source_lines = source_lines
+        self.source = source
+        self.encoding = encoding
+
+        # Byte offset at which each line starts
+        self.line_offsets = [0]
+        self.line_offsets.extend(m.end() for m in _NEWLINE.finditer(source))
 
         self.chunks = []
 
         # Import context
         self.imported_modules = set()
         self.imported_symbols = {}
+        self._module_intents = None
 
         # Scope tracking
         self.current_class = None
         self.current_function = None
 
+        # Call nodes / control flow collected for each open class or function
+        self._scopes = []
+
         # File-level context
         self.file_role = infer_file_role(file_path)
 
@@ -34,6 +92,7 @@ class PythonChunkExtractor(ast.NodeVisitor):
     def visit_Import(self, node):
         for alias in node.names:
             self.imported_modules.add(alias.name)
+        self._module_intents = None
         self.generic_visit(node)
 
     def visit_ImportFrom(self, node):
@@ -42,22 +101,51 @@ class PythonChunkExtractor(ast.NodeVisitor):
                 self.imported_symbols[alias.asname or alias.name] = node.module
         self.generic_visit(node)
 
+    def _snapshot_imports(self):
+        """
+        Import context as seen where a class/function is defined, so
+        imports inside its body do not leak into its own chunk. Sorted
+        so retrieval text (and its embedding cache key) is stable
+        across runs regardless of set ordering.
+        """
+        return {
+            "modules": sorted(self.imported_modules),
+            "symbols": dict(sorted(self.imported_symbols.items())),
+        }
+
+    @property
+    def module_intents(self):
+        """
+        Import-derived intents, recomputed only after a new import.
+        """
+        if self._module_intents is None:
+            self._module_intents = infer_module_intents(self.imported_modules)
+        return self._module_intents
+
     # ---------------- CLASSES ----------------
 
     def visit_ClassDef(self, node):
         prev_class = self.current_class
         self.current_class = node.name
 
+        slot = len(self.chunks)
+        docstring = extract_docstring(node)
+        intent_tags = infer_intent(node.name, self.module_intents)
+        imports = self._snapshot_imports()
+
+        scope = self._visit_scope(node)
+
         self._create_chunk(
+            slot=slot,
             node=node,
             chunk_type="class",
             name=node.name,
-            docstring=extract_docstring(node),
-            control_flow=detect_control_flow(node),
-            intent_tags=infer_intent(node.name, self.imported_modules),
+            docstring=docstring,
+            control_flow=sorted(scope["control_flow"]),
+            intent_tags=intent_tags,
+            imports=imports,
         )
 
-        self.generic_visit(node)
         self.current_class = prev_class
 
     # ---------------- FUNCTIONS ----------------
@@ -66,48 +154,113 @@ class PythonChunkExtractor(ast.NodeVisitor):
         prev_function = self.current_function
         self.current_function = node.name
 
+        slot = len(self.chunks)
+        chunk_type = "method" if self.current_class else "function"
+        docstring = extract_docstring(node)
+        intent_tags = infer_intent(node.name, self.module_intents)
+        imports = self._snapshot_imports()
+
+        scope = self._visit_scope(node)
+
         self._create_chunk(
+            slot=slot,
             node=node,
-            chunk_type="method" if self.current_class else "function",
+            chunk_type=chunk_type,
             name=node.name,
-            calls=self._extract_calls(node),
-            docstring=extract_docstring(node),
-            control_flow=detect_control_flow(node),
-            intent_tags=infer_intent(node.name, self.imported_modules),
+            calls=self._resolve_calls(scope["calls"], imports["symbols"]),
+            docstring=docstring,
+            control_flow=sorted(scope["control_flow"]),
+            intent_tags=intent_tags,
+            imports=imports,
         )
 
-        self.generic_visit(node)
         self.current_function = prev_function
 
-    # ---------------- CALL EXTRACTION ----------------
+    # ---------------- SCOPE TRACKING ----------------
 
-    def _extract_calls(self, node):
-        calls = []
+    def _visit_scope(self, node):
+        """
+        Visits the body of a class/function while collecting its calls
+        and control flow, so the tree is only walked once per file.
+        Nested scopes also count towards their parents.
+        """
+        scope = {"calls": [], "control_flow": set()}
+        self._scopes.append(scope)
+        self.generic_visit(node)
+        self._scopes.pop()
+
+        if self._scopes:
+            parent = self._scopes[-1]
+            parent["calls"].extend(scope["calls"])
+            parent["control_flow"].update(scope["control_flow"])
+
+        return scope
+
+    # ---------------- CONTROL FLOW ----------------
+
+    def _add_control_flow(self, flag):
+        if self._scopes:
+            self._scopes[-1]["control_flow"].add(flag)
 
-        for child in ast.walk(node):
-            if isinstance(child, ast.Call):
-                if isinstance(child.func, ast.Name):
-                    name = child.func.id
-                    calls.append({
-                        "name": name,
-                        "resolved_via": "import"
-                        if name in self.imported_symbols else "local_or_unknown",
-                        "module": self.imported_symbols.get(name),
-                    })
-
-                elif isinstance(child.func, ast.Attribute):
-                    calls.append({
-                        "name": ast.unparse(child.func),
-                        "resolved_via": "attribute",
-                        "module": None,
-                    })
+    def visit_Try(self, node):
+        self._add_control_flow("exception_handling")
+        self.generic_visit(node)
+
+    def visit_If(self, node):
+        self._add_control_flow("conditional_logic")
+        self.generic_visit(node)
+
+    def visit_For(self, node):
+        self._add_control_flow("looping")
+        self.generic_visit(node)
+
+    def visit_While(self, node):
+        self._add_control_flow("looping")
+        self.generic_visit(node)
 
+    # ---------------- CALL EXTRACTION ----------------
+
+    def visit_Call(self, node):
+        if self._scopes:
+            self._scopes[-1]["calls"].append(node)
+        self.generic_visit(node)
+
+    def _resolve_calls(self, call_nodes, imported_symbols):
+        """
+        Call nodes are resolved against the imports visible where the
+        enclosing definition starts.
+        """
+        calls = []
+        for node in call_nodes:
+            call = self._describe_call(node, imported_symbols)
+            if call:
+                calls.append(call)
         return calls
 
+    def _describe_call(self, node, imported_symbols):
+        if isinstance(node.func, ast.Name):
+            name = node.func.id
+            return {
+                "name": name,
+                "resolved_via": "import"
+                if name in imported_symbols else "local_or_unknown",
+                "module": imported_symbols.get(name),
+            }
+
+        if isinstance(node.func, ast.Attribute):
+            return {
+                "name": _attr_name(node.func),
+                "resolved_via": "attribute",
+                "module": None,
+            }
+
+        return None
+
     # ---------------- CHUNK CREATION ----------------
 
     def _create_chunk(
         self,
+        slot,
         node,
         chunk_type,
         name,
@@ -115,10 +268,18 @@ class PythonChunkExtractor(ast.NodeVisitor):
         docstring=None,
         control_flow=None,
         intent_tags=None,
+        imports=None,
     ):
+        imports = imports or self._snapshot_imports()
+
         start = node.lineno - 1
         end = node.end_lineno
-        code = "".join(self.source_lines[start:end])
+        code = self.source[
+            self.line_offsets[start]:
+            self.line_offsets[end] if end < len(self.line_offsets) else len(self.source)
+        ].decode(self.encoding, errors="replace")
+        # Same universal-newline translation read_text used to apply
+        code = code.replace("\r\n", "\n").replace("\r", "\n")
 
         retrieval_text = self._build_retrieval_text(
             chunk_type=chunk_type,
@@ -127,9 +288,12 @@ class PythonChunkExtractor(ast.NodeVisitor):
             intent_tags=intent_tags,
             control_flow=control_flow,
             calls=calls,
+            imports=imports,
         )
 
-        self.chunks.append({
+        # Nested chunks are created first; insert so parents keep
+        # appearing before their children.
+        self.chunks.insert(slot, {
             "type": chunk_type,
             "name": name,
             "file_path": self.file_path,
@@ -140,10 +304,7 @@ class PythonChunkExtractor(ast.NodeVisitor):
             "intent_tags": intent_tags or [],
             "control_flow": control_flow or [],
             "docstring": docstring,
-            "imports": {
-                "modules": list(self.imported_modules),
-                "symbols": self.imported_symbols,
-            },
+            "imports": imports,
             "calls": calls or [],
             "code": code,
             "retrieval_text": retrieval_text,
@@ -159,6 +320,7 @@ class PythonChunkExtractor(ast.NodeVisitor):
         intent_tags,
         control_flow,
         calls,
+        imports,
     ):
         """
         This is the most important function for RAG quality.
@@ -190,8 +352,8 @@ DOCSTRING SUMMARY:
 {docstring or "No docstring provided."}
 
 IMPORT CONTEXT:
-Modules → {", ".join(self.imported_modules)}
-Imported Symbols → {", ".join(self.imported_symbols.keys())}
+Modules → {", ".join(imports["modules"])}
+Imported Symbols → {", ".join(imports["symbols"].keys())}
 
 FUNCTION CALLS:
 {", ".join(call_names) if call_names else "No explicit function calls."}
@@ -203,27 +365,163 @@ modules and function calls listed above.
 """.strip()
 
 
-# ---------------- REPO DRIVER ----------------
+# ---------------- FILE DRIVER ----------------
+
+def _cache_key(file_path: str, source) -> str:
+    # The path is part of the key because chunks record it
+    digest = hashlib.sha256(file_path.encode())
+    digest.update(source)
+    digest.update(sys.version.encode())
+    digest.update(SCHEMA_VERSION)
+    return digest.hexdigest()
+
+
+def _write_cache(cache_path: Path, chunks: List[Dict]):
+    """
+    Write atomically so a crash or a concurrent writer never leaves
+    a truncated pickle behind.
+    """
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(chunks, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def extract_chunks_from_file(py_file, cache_dir=AST_CACHE_DIR) -> List[Dict]:
+    """
+    Extract chunks from a single file, reusing the cached result when
+    the file contents have not changed since the last run.
+    """
+    return _extract_file_entry(py_file, cache_dir)[1]
+
+
+def _extract_file_entry(py_file, cache_dir):
+    """
+    Returns (cache entry name, chunks); the name is None when the file
+    could not be read or caching is disabled.
+    """
+    py_file = Path(py_file)
+
+    try:
+        with open(py_file, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None, []  # empty files cannot be mapped and have no chunks
+
+            # Parse straight from the mapping; only chunk slices get decoded
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+                return _extract_chunks(py_file, source, cache_dir)
+    except (OSError, ValueError):
+        return None, []
+
+
+def _extract_chunks(py_file: Path, source, cache_dir):
+    cache_name = None
+    cache_path = None
+    if cache_dir is not None:
+        cache_name = f"{_cache_key(str(py_file), source)}.pkl"
+        cache_path = Path(cache_dir) / cache_name
+        try:
+            with open(cache_path, "rb") as f:
+                return cache_name, pickle.load(f)
+        except Exception:
+            pass
+
+    try:
+        tree = ast.parse(source, filename=str(py_file), type_comments=False)
+        # Same PEP 263 / BOM detection the parser applied ("utf-8-sig"
+        # strips the BOM from the first chunk)
+        encoding, _ = tokenize.detect_encoding(source.readline)
+    except Exception:
+        return cache_name, []
+
+    extractor = PythonChunkExtractor(
+        file_path=str(py_file),
+        source=source,
+        encoding=encoding,
+    )
+    extractor.visit(tree)
+
+    if cache_path is not None:
+        _write_cache(cache_path, extractor.chunks)
+
+    return cache_name, extractor.chunks
+
+
+def _prune_cache(cache_dir, keep):
+    """
+    Deletes cache entries outside `keep`: results for edited or removed
+    files, older SCHEMA_VERSIONs and other interpreter versions.
+    """
+    try:
+        entries = list(os.scandir(cache_dir))
+    except OSError:
+        return
+
+    for entry in entries:
+        if entry.name.endswith(".pkl") and entry.name not in keep:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
 
-def extract_chunks_from_repo(repo_path: str) -> List[Dict]:
-    repo_path = Path(repo_path)
-    all_chunks = []
 
-    for py_file in repo_path.rglob("*.py"):
-        if "venv" in py_file.parts or "__pycache__" in py_file.parts:
-            continue
+# ---------------- REPO DRIVER ----------------
 
+def walk_py_files(root):
+    """
+    Yields paths of .py files under root. DirEntry caches the file type
+    from the directory listing, so no extra stat call is made per entry.
+    """
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
         try:
-            source = py_file.read_text(encoding="utf-8")
-            tree = ast.parse(source)
-        except Exception:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in EXCLUDED_DIRS:
+                            stack.append(entry.path)
+                    elif entry.name.endswith(".py") and entry.is_file():
+                        yield entry.path
+        except OSError:
             continue
 
-        extractor = PythonChunkExtractor(
-            file_path=str(py_file),
-            source_lines=source.splitlines(keepends=True),
-        )
-        extractor.visit(tree)
-        all_chunks.extend(extractor.chunks)
+
+def extract_chunks_from_repo(
+    repo_path: str,
+    cache_dir=AST_CACHE_DIR,
+    max_workers=None,
+) -> List[Dict]:
+    """
+    Files are parsed in a process pool. Callers on platforms that
+    spawn workers (Windows, macOS) must run this under
+    `if __name__ == "__main__":`.
+
+    After the run the AST cache holds only this repo's current files;
+    entries from earlier runs (including other repos sharing cache_dir)
+    are deleted. Removing cache_dir clears it entirely.
+    """
+    repo_path = Path(repo_path)
+
+    py_files = list(walk_py_files(repo_path))
+
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(
+            partial(_extract_file_entry, cache_dir=cache_dir),
+            py_files,
+            chunksize=8,
+        ))
+
+    all_chunks = list(itertools.chain.from_iterable(
+        chunks for _, chunks in results
+    ))
+
+    if cache_dir is not None:
+        _prune_cache(cache_dir, {name for name, _ in results if name})
 
     return all_chunks
@@ -1,29 +1,57 @@
 # 
 
-import json
+import hashlib
+import os
 from pathlib import Path
 import faiss
+import msgpack
 import numpy as np
 from sentence_transformers import SentenceTransformer
 
 
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_MIN_EF_SEARCH = 64
+
+# Stored vector precision; QT_8bit quarters memory at a small recall cost
+SQ_QTYPE = faiss.ScalarQuantizer.QT_fp16
+
+# Loaded models shared by every CodeEmbedder in the process
+_MODEL_SINGLETON = {}
+
+
+def load_model(model_name):
+    """
+    Loads a SentenceTransformer once per process. On CUDA the weights
+    are cast to FP16, which roughly doubles encode throughput.
+    """
+    if model_name not in _MODEL_SINGLETON:
+        model = SentenceTransformer(model_name)
+        if model.device.type == "cuda":
+            model.half()
+        _MODEL_SINGLETON[model_name] = model
+
+    return _MODEL_SINGLETON[model_name]
+
+
 class CodeEmbedder:
     def __init__(
         self,
         model_name="BAAI/bge-large-zh-v1.5",
         store_dir="output"
     ):
-        self.model = SentenceTransformer(model_name)
+        self.model_name = model_name
+        self.model = load_model(model_name)
+        self.dim = self.model.get_sentence_embedding_dimension()
         self.store_dir = Path(store_dir)
         self.store_dir.mkdir(exist_ok=True)
 
         self.index_path = self.store_dir / "index.faiss"
-        self.chunks_path = self.store_dir / "chunks.json"
-        self.id_map_path = self.store_dir / "id_map.json"
+        self.chunks_path = self.store_dir / "chunks.msgpack"
+        self.emb_cache_path = self.store_dir / "emb-cache.npz"
 
         self.index = None
-        self.chunks = []
-        self.id_map = {}
+        self.chunks = []  # FAISS id i maps to self.chunks[i]
 
         self._load_if_exists()
 
@@ -31,78 +59,192 @@ class CodeEmbedder:
     # Load persisted state
     # -------------------------
     def _load_if_exists(self):
-        if self.index_path.exists():
-            self.index = faiss.read_index(str(self.index_path))
-            print("Loaded FAISS index from disk")
+        """
+        Loads the index only together with a chunk store of matching
+        size; anything else is left for build_index to rebuild.
+        """
+        if not (self.index_path.exists() and self.chunks_path.exists()):
+            return
 
-        if self.chunks_path.exists():
-            self.chunks = json.loads(self.chunks_path.read_text())
-            print("Loaded chunks metadata")
+        index = faiss.read_index(str(self.index_path))
+        chunks = msgpack.unpackb(self.chunks_path.read_bytes())
 
-        if self.id_map_path.exists():
-            self.id_map = json.loads(self.id_map_path.read_text())
-            print("Loaded id map")
+        if index.ntotal != len(chunks):
+            print("FAISS index and chunks metadata out of sync — will rebuild")
+            return
+
+        self.index = index
+        self.chunks = chunks
+        print("Loaded FAISS index and chunks metadata from disk")
 
     # -------------------------
     # Build & persist index
     # -------------------------
-    def build_index(self, chunks):
-        if self.index is not None:
+    def build_index(self, chunks, rebuild=False):
+        """
+        Pass rebuild=True to re-index a changed repo; only chunks whose
+        retrieval text is not in the embedding cache get re-encoded.
+        """
+        if self.index is not None and not rebuild:
             print("Index already exists — skipping rebuild")
             return
 
-        texts = [c["retrieval_text"] for c in chunks]
-
-        embeddings = self.model.encode(
-            texts,
-            batch_size=16,
-            show_progress_bar=True,
-            convert_to_numpy=True,
-            normalize_embeddings=True
-        )
+        embeddings = self._embed_chunks(chunks)
 
         dim = embeddings.shape[1]
-        self.index = faiss.IndexFlatIP(dim)  # cosine similarity
+        # Approximate inner-product (cosine) search over half-precision vectors
+        self.index = faiss.IndexHNSWSQ(
+            dim, SQ_QTYPE, HNSW_M, faiss.METRIC_INNER_PRODUCT
+        )
+        self.index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        self.index.train(embeddings)
         self.index.add(embeddings)
+        del embeddings  # the index keeps its own quantized copy
 
         self.chunks = chunks
-        self.id_map = {str(i): i for i in range(len(chunks))}
 
         self._persist()
 
         print(f"FAISS index built with {len(chunks)} vectors")
 
     # -------------------------
-    # Save everything
+    # Embedding cache
     # -------------------------
-    def _persist(self):
-        faiss.write_index(self.index, str(self.index_path))
+    def _embedding_key(self, text):
+        return hashlib.sha256(
+            f"{self.model_name}|{self.dim}|{text}".encode()
+        ).hexdigest()
+
+    def _load_embedding_cache(self):
+        """
+        Returns {hash: vector}. The cache is dropped when it was built
+        with a different model or embedding size.
+        """
+        if not self.emb_cache_path.exists():
+            return {}
+
+        with np.load(self.emb_cache_path) as data:
+            if (
+                str(data["model_name"]) != self.model_name
+                or int(data["dim"]) != self.dim
+            ):
+                return {}
 
-        self.chunks_path.write_text(
-            json.dumps(self.chunks, indent=2)
+            return dict(zip(data["keys"].tolist(), data["vectors"]))
+
+    def _save_embedding_cache(self, cache):
+        keys = list(cache)
+        vectors = (
+            np.stack([cache[k] for k in keys])
+            if keys else np.empty((0, self.dim), dtype=np.float32)
+        )
+
+        # Metadata lives in the same archive so it is swapped in
+        # atomically together with the vectors it describes
+        tmp_path = self.emb_cache_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                model_name=np.array(self.model_name),
+                dim=np.array(self.dim),
+                keys=np.array(keys, dtype=str),
+                vectors=vectors,
+            )
+        os.replace(tmp_path, self.emb_cache_path)
+
+    def _embed_chunks(self, chunks):
+        """
+        Encodes each distinct retrieval text once, and only if it is not
+        already cached, then scatters the vectors back to chunk order.
+        """
+        text_to_idx = {}
+        for i, chunk in enumerate(chunks):
+            text_to_idx.setdefault(chunk["retrieval_text"], []).append(i)
+
+        cache = self._load_embedding_cache()
+        keys = {text: self._embedding_key(text) for text in text_to_idx}
+
+        miss_texts = [text for text, key in keys.items() if key not in cache]
+        if miss_texts:
+            miss_embeddings = self.model.encode(
+                miss_texts,
+                batch_size=64,
+                show_progress_bar=True,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            ).astype(np.float32)
+
+            for text, vec in zip(miss_texts, miss_embeddings):
+                cache[keys[text]] = vec
+
+        print(
+            f"Embedding {len(chunks)} chunks: {len(text_to_idx)} unique texts, "
+            f"{len(miss_texts)} not cached"
+        )
+
+        embeddings = np.empty((len(chunks), self.dim), dtype=np.float32)
+        for text, indices in text_to_idx.items():
+            embeddings[indices] = cache[keys[text]]
+
+        self._save_embedding_cache(
+            {key: cache[key] for key in keys.values()}
         )
 
-        self.id_map_path.write_text(
-            json.dumps(self.id_map, indent=2)
+        return embeddings
+
+    # -------------------------
+    # Save everything
+    # -------------------------
+    def _persist(self):
+        # Write to temp files and swap in, so a crash never leaves a
+        # half-written index or chunk store behind
+        tmp_index_path = self.index_path.with_suffix(".tmp")
+        faiss.write_index(self.index, str(tmp_index_path))
+        os.replace(tmp_index_path, self.index_path)
+
+        tmp_chunks_path = self.chunks_path.with_suffix(".tmp")
+        tmp_chunks_path.write_bytes(
+            msgpack.packb(self.chunks, use_bin_type=True)
         )
+        os.replace(tmp_chunks_path, self.chunks_path)
 
     # -------------------------
     # Search
     # -------------------------
     def search(self, query, k=5):
+        return self.search_batch([query], k=k)[0]
+
+    def search_batch(self, queries, k=5):
+        """
+        Encodes all queries in one batch and returns a result list
+        per query, in the same order.
+        """
         if self.index is None:
             raise RuntimeError("Index not built")
 
         q_emb = self.model.encode(
-            [query],
+            queries,
+            batch_size=32,
             convert_to_numpy=True,
             normalize_embeddings=True
-        )
+        ).astype(np.float32)
+
+        # Indexes persisted before the switch to HNSW are still flat
+        if hasattr(self.index, "hnsw"):
+            self.index.hnsw.efSearch = max(HNSW_MIN_EF_SEARCH, k * 8)
 
         scores, ids = self.index.search(q_emb, k)
 
+        return [
+            self._collect_results(query_ids, query_scores)
+            for query_ids, query_scores in zip(ids, scores)
+        ]
+
+    def _collect_results(self, ids, scores):
         results = []
-        for idx, score in zip(ids[0], scores[0]):
+        for idx, score in zip(ids, scores):
+            if idx < 0:  # fewer than k neighbours found
+                continue
             chunk = self.chunks[idx]
             results.append({
                 "score": float(score),
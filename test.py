@@ -47,50 +47,56 @@
 #     print("Intent:", r.get("intent_tags"))
 #     print("-" * 60)
 from pathlib import Path
-import json
+
+import orjson
 
 from chunker import extract_chunks_from_repo
 from embedder import CodeEmbedder
 from llm import generate_answer
 
-# ---------------- CONFIG ----------------
 
-repo_path = Path("D:\\youtube-datalake\\dags").resolve()
-output_path = Path("output/chunks.json")
+def main():
+    # ---------------- CONFIG ----------------
+
+    repo_path = Path("D:\\youtube-datalake\\dags").resolve()
+    output_path = Path("output/chunks.json")
+
+
+    # ---------------- CHUNK EXTRACTION ----------------
 
+    chunks = extract_chunks_from_repo(repo_path)
 
-# ---------------- CHUNK EXTRACTION ----------------
+    print(f"Extracted {len(chunks)} chunks")
 
-chunks = extract_chunks_from_repo(repo_path)
+    output_path.parent.mkdir(exist_ok=True)
 
-print(f"Extracted {len(chunks)} chunks")
+    output_path.write_bytes(orjson.dumps(chunks, option=orjson.OPT_INDENT_2))
 
-output_path.parent.mkdir(exist_ok=True)
+    print(f"Chunks written to {output_path}")
 
-with open(output_path, "w", encoding="utf-8") as f:
-    json.dump(chunks, f, indent=2)
 
-print(f"Chunks written to {output_path}")
+    # ---------------- EMBEDDING + INDEX ----------------
 
+    embedder = CodeEmbedder()
+    embedder.build_index(chunks)
 
-# ---------------- EMBEDDING + INDEX ----------------
+    print("FAISS index ready")
 
-embedder = CodeEmbedder()
-embedder.build_index(chunks)
 
-print("FAISS index ready")
+    # ---------------- SEARCH TEST ----------------
 
+    query = "Where are files uploaded to an S3 bucket?"
 
-# ---------------- SEARCH TEST ----------------
+    results = embedder.search(query, k=3)
 
-query = "Where are files uploaded to an S3 bucket?"
+    answer = generate_answer(
+        question=query,
+        retrieved_chunks=results
+    )
 
-results = embedder.search(query, k=3)
+    print("\nANSWER:\n")
+    print(answer)
 
-answer = generate_answer(
-    question=query,
-    retrieved_chunks=results
-)
 
-print("\nANSWER:\n")
-print(answer)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,14 @@
 import ast
+import re
+
+
+# One pass over the name tags every intent. The lookahead matches
+# zero-width at each position, so overlapping keywords are all found.
+_INTENT_PATTERN = re.compile(
+    r"(?=(?P<authentication>auth|token|jwt|verify|validate)"
+    r"|(?P<data_access>fetch|get|read|load)"
+    r"|(?P<data_persistence>write|save|upload|put))"
+)
 
 
 def extract_docstring(node):
@@ -8,48 +18,35 @@ def extract_docstring(node):
     return ast.get_docstring(node)
 
 
-def detect_control_flow(node):
+def infer_module_intents(imported_modules):
     """
-    Detect high-level control flow patterns inside a node.
-    This is NOT deep analysis — just semantic hints for retrieval.
+    Infer the intents implied by a file's imports alone.
+    Computed once per import set and passed to infer_intent.
     """
-    flags = set()
+    intents = set()
+
+    # Newline-joined so a substring test can never span two module names
+    modules_blob = "\n".join(imported_modules)
 
-    for child in ast.walk(node):
-        if isinstance(child, ast.Try):
-            flags.add("exception_handling")
-        elif isinstance(child, ast.If):
-            flags.add("conditional_logic")
-        elif isinstance(child, (ast.For, ast.While)):
-            flags.add("looping")
+    if "boto3" in modules_blob or "s3" in modules_blob:
+        intents.add("cloud_storage")
+
+    if "requests" in modules_blob or "http" in modules_blob:
+        intents.add("networking")
 
-    return list(flags)
+    return frozenset(intents)
 
 
-def infer_intent(name, imported_modules):
+def infer_intent(name, module_intents=frozenset()):
     """
     Infer intent using deterministic, explainable heuristics.
     This is important for interviews and debugging.
     """
     name = name.lower()
-    intents = set()
-
-    if any(k in name for k in ["auth", "token", "jwt", "verify", "validate"]):
-        intents.add("authentication")
-
-    if any(k in name for k in ["fetch", "get", "read", "load"]):
-        intents.add("data_access")
-
-    if any(k in name for k in ["write", "save", "upload", "put"]):
-        intents.add("data_persistence")
-
-    if any("boto3" in m or "s3" in m for m in imported_modules):
-        intents.add("cloud_storage")
-
-    if any("requests" in m or "http" in m for m in imported_modules):
-        intents.add("networking")
+    intents = {m.lastgroup for m in _INTENT_PATTERN.finditer(name)}
+    intents.update(module_intents)
 
-    return list(intents)
+    return sorted(intents)
 
 
 def infer_file_role(file_path: str):